@@ -1,9 +1,15 @@
 import os
-import re
+import asyncio
+import functools
+import pathlib
+import queue
 import sqlite3
-from contextlib import closing
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing, contextmanager
 from dataclasses import dataclass
-from typing import Optional, List
+from typing import Awaitable, Callable, Dict, Iterator, Optional, List, Set, Tuple
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
@@ -15,8 +21,9 @@ from telegram.ext import (
     filters,
 )
 
-# Подключаем поиск (hybrid_search) + загрузку кеша вопросов + инициализацию моделей (ST + FAISS) один раз на старте
-from find_candidates import hybrid_search, load_all_questions, init_models_once
+# Подключаем поиск (hybrid_search) + загрузку кеша вопросов + инициализацию моделей (ST + FAISS) один раз на старте.
+# norm берём оттуда же, чтобы у UI и поиска был один общий кеш нормализации
+from find_candidates import hybrid_search, load_all_questions, init_models_once, flush_query_cache, norm
 
 
 # берем папку, где лежит bot.py, и ожидаем, что qa.db лежит рядом
@@ -28,10 +35,22 @@ SHORT_LIMIT = 900
 
 FULL_CHUNK = 3500
 
+# сколько read-only соединений с SQLite держим в пуле
+DB_READERS = int(os.getenv("DB_READERS", "4"))
 
-def norm(s: str) -> str:
-    """Нормализуем текст: схлопываем пробелы/переносы и обрезаем по краям."""
-    return re.sub(r"\s+", " ", (s or "").strip())
+# PRAGMA под чтение, общие для writer и read-only соединений:
+# читаем базу через mmap (до 1 ГБ), временные структуры держим в памяти, page cache ~128 МБ
+READ_PRAGMAS = (
+    "PRAGMA mmap_size=1073741824;",
+    "PRAGMA temp_store=MEMORY;",
+    "PRAGMA cache_size=-131072;",
+)
+
+# сколько потоков отдаём под тяжелую синхронную работу (FAISS, SQLite, модель)
+EXECUTOR_WORKERS = int(os.getenv("EXECUTOR_WORKERS", str((os.cpu_count() or 1) * 2)))
+
+# через сколько секунд простоя останавливаем воркер очереди чата
+CHAT_IDLE_TIMEOUT = float(os.getenv("CHAT_IDLE_TIMEOUT", "60"))
 
 
 @dataclass
@@ -55,23 +74,29 @@ def row_tuple_to_obj(t: tuple) -> Row:
     """
     Превращаем кортеж, который вернула SQLite (SELECT ...),
     в объект Row с безопасными значениями по умолчанию.
+    question/answer нормализуем сразу, чтобы дальше norm() по ним был просто попаданием в кеш.
     """
     return Row(
         id=int(t[0]),
         page=t[1] or "unknown",
-        question=t[2] or "",
-        answer=t[3] or "",
+        question=norm(t[2] or ""),
+        answer=norm(t[3] or ""),
         source_url=t[4] or "",
     )
 
 
-def chunk_text(s: str, n: int) -> List[str]:
+def chunk_text(s: str, n: int) -> Iterator[str]:
     """
     Делим длинный текст на части по n символов, чтобы корректно отправлять в Telegram.
-    Если строка пустая — возвращаем список из одного пустого элемента (для единообразия).
+    Части отдаём по одной (генератор), чтобы не держать все куски в памяти во время отправки.
+    Если строка пустая — отдаём один пустой элемент (для единообразия).
     """
     s = s or ""
-    return [s[i: i + n] for i in range(0, len(s), n)] if s else [""]
+    if len(s) <= n:
+        yield s
+        return
+    for i in range(0, len(s), n):
+        yield s[i: i + n]
 
 
 # ---------------- UI: клавиатура и форматирование сообщений ----------------
@@ -143,7 +168,60 @@ def format_full_answer(row: Row, show_q: bool) -> str:
     return "\n\n".join(parts)
 
 
-# держим соединение с SQLite глобально, чтобы не пересоздавать на каждый апдейт
+class ConnectionPool:
+    """
+    Пул соединений с SQLite:
+    - одно соединение на запись (writer) — через него пишем кеш эмбеддингов запросов
+    - N read-only соединений для SELECT-ов, чтобы чтения из разных потоков не стояли в очереди за одним соединением
+    """
+
+    def __init__(self, db_path: str, readers: int = DB_READERS):
+        # check_same_thread=False нужно, т.к. Telegram обработчики могут быть в разных потоках
+        self.writer = sqlite3.connect(db_path, check_same_thread=False)
+        self._readers: "queue.Queue[sqlite3.Connection]" = queue.Queue()
+        for _ in range(max(1, readers)):
+            # путь переводим в корректный file: URI (экранируем ?, #, % и т.п. в пути)
+            ro_uri = pathlib.Path(db_path).resolve().as_uri() + "?mode=ro"
+            rcon = sqlite3.connect(ro_uri, uri=True, check_same_thread=False)
+            with closing(rcon.cursor()) as cur:
+                cur.execute("PRAGMA query_only=1;")
+                for pragma in READ_PRAGMAS:
+                    cur.execute(pragma)
+            self._readers.put(rcon)
+
+    @contextmanager
+    def borrow(self) -> Iterator[sqlite3.Cursor]:
+        """Берём read-only соединение из пула и отдаём курсор; после with возвращаем соединение обратно."""
+        rcon = self._readers.get()
+        try:
+            with closing(rcon.cursor()) as cur:
+                yield cur
+        finally:
+            self._readers.put(rcon)
+
+    def close(self) -> None:
+        """Закрываем все соединения пула."""
+        while not self._readers.empty():
+            self._readers.get_nowait().close()
+        self.writer.close()
+
+
+def build_card(query: str, row: Row, idx: int, total: int) -> Tuple[str, str, bool, bool]:
+    """
+    Заранее собираем всё, что нужно для показа карточки, чтобы кнопки не форматировали текст заново:
+    (текст с вопросом, текст без вопроса, has_full, has_source)
+    """
+    return (
+        format_answer_message(query, row, idx, total, show_q=True),
+        format_answer_message(query, row, idx, total, show_q=False),
+        len(norm(row.answer)) > SHORT_LIMIT,
+        bool(row.source_url),
+    )
+
+
+# держим соединения с SQLite глобально, чтобы не пересоздавать на каждый апдейт:
+# pool — пул (writer + readers), con — его writer
+pool: Optional[ConnectionPool] = None
 con: Optional[sqlite3.Connection] = None
 
 # кеш всех вопросов (id, question), грузим один раз на старте.
@@ -152,6 +230,134 @@ con: Optional[sqlite3.Connection] = None
 all_q_cache = None
 
 
+# кеш записей qa по id (только найденные записи: отсутствие не кешируем, запись может появиться позже)
+ROW_CACHE_SIZE = 2048
+_row_cache_lock = threading.Lock()
+_row_cache: "OrderedDict[int, Row]" = OrderedDict()
+
+
+def cache_row(row: Row) -> None:
+    """Кладём запись в кеш get_row (например, строки, которые уже вернул hybrid_search)."""
+    with _row_cache_lock:
+        _row_cache[row.id] = row
+        _row_cache.move_to_end(row.id)
+        while len(_row_cache) > ROW_CACHE_SIZE:
+            _row_cache.popitem(last=False)
+
+
+def get_row(qa_id: int) -> Optional[Row]:
+    """
+    Достаём запись qa по ID: сначала из кеша, иначе через read-only соединение из пула.
+    Кешируем: в user_data храним только id результатов, а сами записи берём отсюда.
+    """
+    with _row_cache_lock:
+        row = _row_cache.get(qa_id)
+        if row is not None:
+            _row_cache.move_to_end(qa_id)
+            return row
+
+    with pool.borrow() as cur:
+        r = cur.execute(
+            "SELECT id, page, question, answer_text, source_url FROM qa WHERE id = ?;",
+            (qa_id,),
+        ).fetchone()
+    if not r:
+        return None
+
+    row = row_tuple_to_obj(r)
+    cache_row(row)
+    return row
+
+
+@functools.lru_cache(maxsize=4096)
+def _card_cached(query: str, qa_id: int, idx: int, total: int) -> Tuple[str, str, bool, bool]:
+    """Собираем карточку через get_row; если записи нет — KeyError (исключения lru_cache не кеширует)."""
+    row = get_row(qa_id)
+    if row is None:
+        raise KeyError(qa_id)
+    return build_card(query, row, idx, total)
+
+
+def get_card(query: str, qa_id: int, idx: int, total: int) -> Optional[Tuple[str, str, bool, bool]]:
+    """Готовая карточка (см. build_card) для результата qa_id; повторные нажатия кнопок попадают в кеш."""
+    try:
+        return _card_cached(query, qa_id, idx, total)
+    except KeyError:
+        return None
+
+
+# пул потоков, который ставим executor'ом по умолчанию для event loop (asyncio.to_thread / run_in_executor)
+executor: Optional[ThreadPoolExecutor] = None
+
+# очередь апдейтов на каждый чат: внутри чата порядок сохраняется, разные чаты обрабатываются параллельно
+_chat_queues: Dict[int, asyncio.Queue] = {}
+# задачи воркеров чатов: держим ссылки сами, чтобы при остановке бота их отменить (см. post_stop)
+_chat_tasks: Set[asyncio.Task] = set()
+
+Handler = Callable[[Update, ContextTypes.DEFAULT_TYPE], Awaitable[None]]
+
+
+async def _chat_worker(chat_id: int, q: asyncio.Queue) -> None:
+    """
+    Разбираем очередь одного чата по порядку.
+    Если чат молчит CHAT_IDLE_TIMEOUT секунд — убираем очередь и завершаемся (при новом апдейте поднимется заново).
+    """
+    while True:
+        try:
+            handler, update, context = await asyncio.wait_for(q.get(), CHAT_IDLE_TIMEOUT)
+        except asyncio.TimeoutError:
+            if q.empty():
+                _chat_queues.pop(chat_id, None)
+                return
+            continue
+
+        try:
+            await handler(update, context)
+        except Exception as e:
+            # ошибки отдаем в общий error handler (on_error), как если бы handler вызывался напрямую
+            await context.application.process_error(update, e)
+
+
+def per_chat(handler: Handler) -> Handler:
+    """
+    Оборачиваем handler: апдейт кладем в очередь своего чата и сразу возвращаемся,
+    чтобы медленный поиск в одном чате не задерживал остальные.
+    """
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        chat = update.effective_chat
+        if chat is None:
+            await handler(update, context)
+            return
+
+        q = _chat_queues.get(chat.id)
+        if q is None:
+            q = asyncio.Queue()
+            _chat_queues[chat.id] = q
+            # не через application.create_task: Application.stop() ждёт такие задачи,
+            # а воркер живёт до CHAT_IDLE_TIMEOUT — остановка бота зависала бы
+            task = asyncio.create_task(_chat_worker(chat.id, q))
+            _chat_tasks.add(task)
+            task.add_done_callback(_chat_tasks.discard)
+        q.put_nowait((handler, update, context))
+
+    return wrapper
+
+
+async def post_init(app: Application) -> None:
+    """После старта event loop ставим наш пул потоков executor'ом по умолчанию."""
+    asyncio.get_running_loop().set_default_executor(executor)
+
+
+async def post_stop(app: Application) -> None:
+    """При остановке бота отменяем воркеры чатов, не дожидаясь CHAT_IDLE_TIMEOUT."""
+    tasks = list(_chat_tasks)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    _chat_queues.clear()
+
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     /start — приветствие и краткая инструкция.
@@ -200,22 +406,16 @@ async def id_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         await update.message.reply_text("ID должен быть числом. Пример: /id 123", disable_web_page_preview=True)
         return
 
-    if con is None:
+    if pool is None:
         await update.message.reply_text("База не подключена.", disable_web_page_preview=True)
         return
 
-    # достаем запись по ID
-    with closing(con.cursor()) as cur:
-        r = cur.execute(
-            "SELECT id, page, question, answer_text, source_url FROM qa WHERE id = ?;",
-            (qa_id,),
-        ).fetchone()
-
-    if not r:
+    # достаем запись по ID через read-only соединение
+    row = await asyncio.to_thread(get_row, qa_id)
+    if row is None:
         await update.message.reply_text("Не нашла запись с таким ID.", disable_web_page_preview=True)
         return
 
-    row = row_tuple_to_obj(r)
     msg = format_full_answer(row, show_q=True)
 
     # Если ответ длинный — отправляем частями
@@ -239,15 +439,16 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         return
 
     # проверяем, что база и кеш вопросов инициализированы
-    if con is None or all_q_cache is None:
+    if con is None or pool is None or all_q_cache is None:
         await update.message.reply_text("База еще не инициализирована.", disable_web_page_preview=True)
         return
 
     # ищем top результатов.
-    best, top, dbg = hybrid_search(
+    best, top, dbg = await hybrid_search(
         con,
         text,
         final_k=5,
+        pool=pool,
     )
 
     # превращаем кортежи из базы в Row-объекты
@@ -255,7 +456,7 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not rows:
         # если результатов нет,
         # очищаем состояние и просим переформулировать
-        context.user_data.pop("results", None)
+        context.user_data.pop("result_ids", None)
         context.user_data.pop("query", None)
         context.user_data.pop("idx", None)
         context.user_data.pop("show_q", None)
@@ -265,18 +466,20 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         )
         return
 
-    # сохраняем состояние выдачи для кнопок
+    # сохраняем состояние выдачи для кнопок: только id, сами записи/карточки берём из кеша (get_row/get_card)
     context.user_data["query"] = text
-    context.user_data["results"] = rows
+    context.user_data["result_ids"] = [r.id for r in rows]
+    # строки уже на руках — кладём их в кеш, чтобы первые нажатия кнопок не ходили в базу
+    for r in rows:
+        cache_row(r)
     context.user_data["idx"] = 0
     context.user_data["show_q"] = False
 
-    # формируем и отправляем первое сообщение
+    # отправляем первое сообщение
     idx = 0
     show_q = False
-    msg = format_answer_message(text, rows[idx], idx, len(rows), show_q=show_q)
-    has_full = len(norm(rows[idx].answer)) > SHORT_LIMIT
-    kb = make_keyboard(idx, len(rows), show_q, has_source=bool(rows[idx].source_url), has_full=has_full)
+    _, msg, has_full, has_source = build_card(text, rows[idx], idx, len(rows))
+    kb = make_keyboard(idx, len(rows), show_q, has_source=has_source, has_full=has_full)
 
     await update.message.reply_text(msg, reply_markup=kb, disable_web_page_preview=True)
 
@@ -293,18 +496,22 @@ async def on_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     q = update.callback_query
     await q.answer()
 
-    rows: List[Row] = context.user_data.get("results") or []
-    if not rows:
+    ids: List[int] = context.user_data.get("result_ids") or []
+    if not ids:
         await q.edit_message_text("Нет сохраненных результатов. Напиши новый запрос 🙂", disable_web_page_preview=True)
         return
 
+    if pool is None:
+        await q.edit_message_text("База не подключена.", disable_web_page_preview=True)
+        return
+
     query_text: str = context.user_data.get("query") or ""
     idx: int = int(context.user_data.get("idx") or 0)
     show_q: bool = bool(context.user_data.get("show_q") or False)
 
     data = q.data
 
-    if data == "next" and idx < len(rows) - 1:
+    if data == "next" and idx < len(ids) - 1:
         idx += 1
         context.user_data["idx"] = idx
 
@@ -317,23 +524,29 @@ async def on_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
         context.user_data["show_q"] = show_q
 
     elif data == "source":
-        r = rows[idx]
-        if r.source_url:
+        r = await asyncio.to_thread(get_row, ids[idx])
+        if r and r.source_url:
             await q.message.reply_text(f"Источник: {r.source_url}", disable_web_page_preview=True)
         return
 
     elif data == "full":
-        r = rows[idx]
+        r = await asyncio.to_thread(get_row, ids[idx])
+        if r is None:
+            return
         full_msg = format_full_answer(r, show_q=show_q)
         for part in chunk_text(full_msg, FULL_CHUNK):
             if part.strip():
                 await q.message.reply_text(part, disable_web_page_preview=True)
         return
     
-    r = rows[idx]
-    msg = format_answer_message(query_text, r, idx, len(rows), show_q=show_q)
-    has_full = len(norm(r.answer)) > SHORT_LIMIT
-    kb = make_keyboard(idx, len(rows), show_q, has_source=bool(r.source_url), has_full=has_full)
+    card = await asyncio.to_thread(get_card, query_text, ids[idx], idx, len(ids))
+    if card is None:
+        await q.edit_message_text("Запись не найдена. Напиши новый запрос 🙂", disable_web_page_preview=True)
+        return
+
+    msg_show_q, msg_hide_q, has_full, has_source = card
+    msg = msg_show_q if show_q else msg_hide_q
+    kb = make_keyboard(idx, len(ids), show_q, has_source=has_source, has_full=has_full)
 
     await q.edit_message_text(msg, reply_markup=kb, disable_web_page_preview=True)
 
@@ -352,13 +565,13 @@ def main() -> None:
     """
     Запускаем бота:
     1) читаем BOT_TOKEN из окружения
-    2) подключаем SQLite
+    2) подключаем SQLite (writer + пул read-only соединений)
     3) настраиваем PRAGMA для адекватной работы с WAL
     4) инициализируем модели/индекс один раз (SentenceTransformer + FAISS)
     5) грузим кеш вопросов
     6) регистрируем handlers и запускаем polling
     """
-    global con, all_q_cache
+    global pool, con, all_q_cache, executor
 
     token = os.getenv("BOT_TOKEN")
     if not token:
@@ -367,13 +580,16 @@ def main() -> None:
     if not os.path.exists(DB_PATH):
         raise FileNotFoundError(f"qa.db not found рядом со скриптом: {DB_PATH}")
 
-    # открываем соединение с SQLite (check_same_thread=False нужно, т.к. Telegram обработчики могут быть в разных потоках)
-    con = sqlite3.connect(DB_PATH, check_same_thread=False)
+    # открываем пул соединений с SQLite: writer для кеша + read-only соединения для выборок
+    pool = ConnectionPool(DB_PATH, DB_READERS)
+    con = pool.writer
 
     # улучшаем параметры SQLite под нагрузку на чтение
     with closing(con.cursor()) as cur:
         cur.execute("PRAGMA journal_mode=WAL;")
         cur.execute("PRAGMA synchronous=NORMAL;")
+        for pragma in READ_PRAGMAS:
+            cur.execute(pragma)
         con.commit()
 
     # инициализируем модель и FAISS индекс один раз, чтобы не строить их на каждый запрос
@@ -384,16 +600,18 @@ def main() -> None:
     all_q_cache = load_all_questions(con)
 
     # собираем приложение и регистрируем обработчики
-    app = Application.builder().token(token).build()
+    executor = ThreadPoolExecutor(max_workers=EXECUTOR_WORKERS)
+    app = Application.builder().token(token).post_init(post_init).post_stop(post_stop).build()
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("help", help_cmd))
     app.add_handler(CommandHandler("id", id_cmd))
 
     # любой текст, который не команда, отправляем в on_text
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, on_text))
+    # (через очередь своего чата, см. per_chat)
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, per_chat(on_text)))
 
-    # все callback_data от inline-кнопок обрабатываем в on_buttons
-    app.add_handler(CallbackQueryHandler(on_buttons))
+    # все callback_data от inline-кнопок обрабатываем в on_buttons (тоже через очередь чата)
+    app.add_handler(CallbackQueryHandler(per_chat(on_buttons)))
 
     # логируем ошибки через on_error
     app.add_error_handler(on_error)
@@ -402,9 +620,11 @@ def main() -> None:
 
     app.run_polling(close_loop=False)
 
-    # После остановки пытаемся аккуратно закрыть соединение
+    # После остановки дописываем кеш эмбеддингов и пытаемся аккуратно закрыть соединение
     try:
-        con.close()
+        flush_query_cache(con, final=True)
+        pool.close()
+        executor.shutdown(wait=False)
     except Exception:
         pass
 
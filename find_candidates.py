@@ -1,9 +1,15 @@
 import os
 import re
+import functools
 import time
+import asyncio
 import sqlite3
+import threading
+from collections import OrderedDict
 from typing import List, Tuple, Optional, Dict
+import hashlib
 import numpy as np
+import torch
 from sentence_transformers import SentenceTransformer
 import faiss # используем для быстрого поиска по косинусному сходству (через inner product)
 
@@ -27,28 +33,103 @@ SEM_THR_DEFAULT = float(os.getenv("SEM_THR", "0.55"))
 # Кешируем эмбеддинги запросов в БД, чтобы не считать их повторно
 CACHE_QUERY_EMB_TO_DB = True
 
+# Сколько эмбеддингов запросов держим в памяти (проверяем до похода в qa_query_cache)
+QUERY_EMB_CACHE_SIZE = int(os.getenv("QUERY_EMB_CACHE_SIZE", "4096"))
+# Запись в qa_query_cache копим в буфере и сбрасываем одной транзакцией раз в QUERY_CACHE_FLUSH_MS
+QUERY_CACHE_FLUSH_MS = int(os.getenv("QUERY_CACHE_FLUSH_MS", "500"))
+
+# HNSW-граф вместо полного перебора: M (связность графа) и efSearch (ширина поиска)
+HNSW_M = int(os.getenv("HNSW_M", "32"))
+HNSW_EF_CONSTRUCTION = int(os.getenv("HNSW_EF_CONSTRUCTION", "200"))
+HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", "64"))
+# На маленькой базе полный перебор быстрее обхода графа, поэтому HNSW включаем только с этого размера
+HNSW_MIN_N = int(os.getenv("HNSW_MIN_N", "2000"))
+
+# Храним вектора в индексе в float16 (ScalarQuantizer): в 2 раза меньше памяти, на cosine это не влияет
+FAISS_FP16 = os.getenv("FAISS_FP16", "1") == "1"
+# Для совсем большой базы переходим на IVF-PQ (сжатие в 16-32 раза ценой небольшой потери точности)
+PQ_MIN_N = int(os.getenv("PQ_MIN_N", "1000000"))
+PQ_NBITS = int(os.getenv("PQ_NBITS", "8"))
+IVF_NPROBE = int(os.getenv("IVF_NPROBE", "16"))
+
+# Переносим индекс на GPU (если собран faiss-gpu и видна хотя бы одна карта)
+FAISS_GPU = os.getenv("FAISS_GPU", "0") == "1"
+FAISS_GPU_DEVICE = int(os.getenv("FAISS_GPU_DEVICE", "0"))
+
+# Сохраняем построенный индекс и qa_id на диск, чтобы на рестарте не пересобирать его из qa_vec
+FAISS_PERSIST = os.getenv("FAISS_PERSIST", "1") == "1"
+INDEX_DIR = os.getenv("FAISS_INDEX_DIR", os.path.dirname(os.path.abspath(__file__)))
+INDEX_PATH = os.path.join(INDEX_DIR, "qa.faiss")
+IDS_PATH = os.path.join(INDEX_DIR, "qa_ids.npy")
+
+# Сколько результатов поиска (qa_id + similarity) держим в памяти по хешу запроса
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "1024"))
+
+# Микробатчинг эмбеддингов: копим запросы до ENCODE_BATCH_WINDOW_MS и кодируем их одним вызовом
+ENCODE_BATCH_WINDOW_MS = float(os.getenv("ENCODE_BATCH_WINDOW_MS", "20"))
+ENCODE_BATCH_SIZE = int(os.getenv("ENCODE_BATCH_SIZE", "32"))
+
 # Оставляем как константу для совместимости (в этом алгоритме не используем)
 MAX_FTS_TOKENS = 20
 
 _st_model: Optional[SentenceTransformer] = None
 _faiss_index = None
 _faiss_ids: Optional[np.ndarray] = None  # (N,) int64
+_gpu_res = None  # faiss.StandardGpuResources, должен жить столько же, сколько GPU-индекс
+_faiss_on_gpu = False  # True только если index_cpu_to_gpu действительно отработал
+_gpu_search_lock = threading.Lock()  # GPU-индекс не потокобезопасен даже на поиск
 _sem_thr: float = SEM_THR_DEFAULT
 
+# init_models_once и кеш поиска могут дёргаться из разных потоков (см. check_same_thread=False в bot.py)
+_init_lock = threading.Lock()
+_search_cache_lock = threading.Lock()
+# (query_hash, top_n) -> (top_ids (K,) int64, top_sims (K,) float32); повторные запросы/нажатия не трогают ни модель, ни FAISS
+_search_cache: "OrderedDict[Tuple[bytes, int], Tuple[np.ndarray, np.ndarray]]" = OrderedDict()
+
+# query_hash -> эмбеддинг запроса (D,) float32
+_query_emb_cache_lock = threading.Lock()
+_query_emb_cache: "OrderedDict[bytes, np.ndarray]" = OrderedDict()
+
+# буфер отложенной записи в qa_query_cache: (query_hash, query_text, created_ts, dim, q_emb)
+_query_cache_write_lock = threading.Lock()
+_query_cache_buffer: List[Tuple[bytes, str, int, int, bytes]] = []
+_query_cache_timer: Optional[threading.Timer] = None
+_query_cache_closed = False  # после финального сброса (остановка бота) таймер больше не заводим
+# executemany+commit из таймера не должен пересекаться с другой записью через то же соединение
+_query_cache_flush_lock = threading.Lock()
+
+# переиспользуемый буфер (1, D) под эмбеддинг запроса, свой на каждый поток
+_q_buf_local = threading.local()
+
+# очередь (text, future) для микробатчинга и фоновая задача, которая её разбирает
+_encode_queue: Optional[asyncio.Queue] = None
+_encode_task: Optional[asyncio.Task] = None
 
+
+_WS = re.compile(r"\s+")
+
+
+@functools.lru_cache(maxsize=4096)
 def norm(s: str) -> str:
-    """Нормализуем текст: схлопываем пробелы и обрезаем края."""
-    return re.sub(r"\s+", " ", (s or "").strip())
+    """Нормализуем текст: схлопываем пробелы/переносы и обрезаем края (общая функция для поиска и bot.py)."""
+    return _WS.sub(" ", (s or "").strip())
+
+
+def blob_dtype(b: bytes, dim: int) -> np.dtype:
+    """Определяем, в каком формате лежит вектор в BLOB: float16 (2 байта на элемент) или float32."""
+    return np.dtype(np.float16) if len(b) == 2 * int(dim) else np.dtype(np.float32)
 
 
-def blob_to_vec(b: bytes, dim: int) -> np.ndarray:
-    """Достаём float32-вектор из BLOB."""
-    return np.frombuffer(b, dtype=np.float32, count=dim)
+def blob_to_vec(b: bytes, dim: int, dtype: Optional[np.dtype] = None) -> np.ndarray:
+    """Достаём вектор из BLOB (dtype по умолчанию определяем по длине BLOB)."""
+    if dtype is None:
+        dtype = blob_dtype(b, dim)
+    return np.frombuffer(b, dtype=dtype, count=dim)
 
 
-def vec_to_blob(v: np.ndarray) -> bytes:
-    """Пишем float32-вектор в BLOB."""
-    v = np.asarray(v, dtype=np.float32)
+def vec_to_blob(v: np.ndarray, dtype: np.dtype = np.float32) -> bytes:
+    """Пишем вектор в BLOB (float32 или float16)."""
+    v = np.asarray(v, dtype=dtype)
     return v.tobytes()
 
 
@@ -60,10 +141,70 @@ def l2_normalize_rows(X: np.ndarray) -> np.ndarray:
     return X / norms
 
 
-def query_hash(text: str) -> str:
-    """Строим стабильный хеш запроса для кеширования эмбеддинга."""
-    import hashlib
-    return hashlib.sha1(norm(text).encode("utf-8")).hexdigest()
+def query_hash(text: str) -> bytes:
+    """
+    Строим стабильный 32-байтный хеш запроса (blake2b из stdlib) для кеширования эмбеддинга.
+    Алгоритм один и не зависит от установленных пакетов, иначе ключи в qa_query_cache «поплывут».
+    text должен быть уже нормализован через norm() -- повторно его не прогоняем.
+    """
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=32).digest()
+
+
+def search_cache_get(qh: bytes, top_n: int) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    """Достаём результат FAISS-поиска из in-memory LRU (или None, если его там нет)."""
+    key = (qh, int(top_n))
+    with _search_cache_lock:
+        hit = _search_cache.get(key)
+        if hit is not None:
+            _search_cache.move_to_end(key)
+        return hit
+
+
+def search_cache_put(qh: bytes, top_n: int, top_ids: np.ndarray, top_sims: np.ndarray) -> None:
+    """Кладём результат FAISS-поиска в in-memory LRU, вытесняя самые старые записи."""
+    key = (qh, int(top_n))
+    # массивы отдаём наружу из кеша, поэтому делаем их read-only
+    top_ids.flags.writeable = False
+    top_sims.flags.writeable = False
+    with _search_cache_lock:
+        _search_cache[key] = (top_ids, top_sims)
+        _search_cache.move_to_end(key)
+        while len(_search_cache) > SEARCH_CACHE_SIZE:
+            _search_cache.popitem(last=False)
+
+
+def search_cache_clear() -> None:
+    """Сбрасываем кеш поиска (нужно, когда индекс пересобран)."""
+    with _search_cache_lock:
+        _search_cache.clear()
+
+
+def purge_legacy_query_cache(con: sqlite3.Connection) -> None:
+    """
+    Удаляем из qa_query_cache строки со старыми ключами (sha1 hex-строкой):
+    сейчас ключ -- 32-байтный BLOB, такие строки больше никогда не найдутся и не перезапишутся.
+    """
+    cur = con.cursor()
+    cur.execute("DELETE FROM qa_query_cache WHERE typeof(query_hash) = 'text';")
+    con.commit()
+
+
+def query_emb_cache_get(qh: bytes) -> Optional[np.ndarray]:
+    """Достаём эмбеддинг запроса из in-memory LRU (или None)."""
+    with _query_emb_cache_lock:
+        emb = _query_emb_cache.get(qh)
+        if emb is not None:
+            _query_emb_cache.move_to_end(qh)
+        return emb
+
+
+def query_emb_cache_put(qh: bytes, emb: np.ndarray) -> None:
+    """Кладём эмбеддинг запроса в in-memory LRU."""
+    with _query_emb_cache_lock:
+        _query_emb_cache[qh] = emb
+        _query_emb_cache.move_to_end(qh)
+        while len(_query_emb_cache) > QUERY_EMB_CACHE_SIZE:
+            _query_emb_cache.popitem(last=False)
 
 
 def ensure_query_cache_table(con: sqlite3.Connection) -> None:
@@ -71,7 +212,7 @@ def ensure_query_cache_table(con: sqlite3.Connection) -> None:
     cur = con.cursor()
     cur.execute("""
     CREATE TABLE IF NOT EXISTS qa_query_cache (
-        query_hash TEXT PRIMARY KEY,
+        query_hash BLOB PRIMARY KEY,
         query_text TEXT,
         created_ts INTEGER NOT NULL,
         dim INTEGER NOT NULL,
@@ -81,30 +222,90 @@ def ensure_query_cache_table(con: sqlite3.Connection) -> None:
     con.commit()
 
 
-def get_cached_query_emb(con: sqlite3.Connection, qh: str) -> Optional[np.ndarray]:
-    """Пробуем достать эмбеддинг запроса из кеша."""
-    cur = con.cursor()
-    row = cur.execute(
-        "SELECT q_emb, dim FROM qa_query_cache WHERE query_hash=?;",
-        (qh,),
-    ).fetchone()
+def get_cached_query_emb(con: sqlite3.Connection, qh: bytes, pool=None) -> Optional[np.ndarray]:
+    """
+    Пробуем достать эмбеддинг запроса из кеша.
+    Если передан pool -- читаем через read-only соединение, writer (con) остаётся только для записи кеша.
+    """
+    sql = "SELECT q_emb, dim FROM qa_query_cache WHERE query_hash=?;"
+    if pool is not None:
+        with pool.borrow() as cur:
+            row = cur.execute(sql, (qh,)).fetchone()
+    else:
+        row = con.cursor().execute(sql, (qh,)).fetchone()
     if not row:
         return None
     blob, dim = row
     return blob_to_vec(blob, int(dim))
 
 
-def put_cached_query_emb(con: sqlite3.Connection, qh: str, query_text: str, emb: np.ndarray) -> None:
-    """Сохраняем эмбеддинг запроса в кеш."""
-    cur = con.cursor()
-    cur.execute(
-        """
-        INSERT OR REPLACE INTO qa_query_cache(query_hash, query_text, created_ts, dim, q_emb)
-        VALUES(?, ?, ?, ?, ?);
-        """,
-        (qh, query_text, int(time.time()), int(emb.shape[0]), vec_to_blob(emb)),
-    )
-    con.commit()
+def put_cached_query_emb(con: sqlite3.Connection, qh: bytes, query_text: str, emb: np.ndarray) -> None:
+    """
+    Сохраняем эмбеддинг запроса в кеш (write-behind).
+    Строку кладём в буфер, а в БД её пишет flush_query_cache по таймеру -- одной транзакцией на пачку.
+    """
+    with _query_cache_write_lock:
+        _query_cache_buffer.append(
+            (qh, query_text, int(time.time()), int(emb.shape[0]), vec_to_blob(emb))
+        )
+        _arm_query_cache_timer(con)
+
+
+def _arm_query_cache_timer(con: sqlite3.Connection) -> None:
+    """Заводим таймер сброса буфера, если он ещё не заведён (вызывать под _query_cache_write_lock)."""
+    global _query_cache_timer
+
+    if _query_cache_timer is None and not _query_cache_closed:
+        _query_cache_timer = threading.Timer(QUERY_CACHE_FLUSH_MS / 1000.0, flush_query_cache, args=(con,))
+        _query_cache_timer.daemon = True
+        _query_cache_timer.start()
+
+
+def flush_query_cache(con: sqlite3.Connection, final: bool = False) -> None:
+    """
+    Пишем накопленный буфер в qa_query_cache одним executemany + commit.
+    Вызывается таймером и при остановке бота (final=True, чтобы не потерять хвост буфера).
+    Если запись не удалась (например, база занята), возвращаем пачку в буфер и пробуем снова по таймеру;
+    при final=True повторять уже некому (соединение сейчас закроют) -- один раз пишем, что пачка потеряна.
+    """
+    global _query_cache_timer, _query_cache_closed
+
+    with _query_cache_write_lock:
+        if final:
+            _query_cache_closed = True
+        batch = _query_cache_buffer[:]
+        _query_cache_buffer.clear()
+        if _query_cache_timer is not None:
+            # при ручном вызове таймер больше не нужен; если это сам таймер -- cancel ни на что не влияет
+            _query_cache_timer.cancel()
+            _query_cache_timer = None
+
+    if not batch:
+        return
+
+    try:
+        with _query_cache_flush_lock:
+            con.executemany(
+                """
+                INSERT OR REPLACE INTO qa_query_cache(query_hash, query_text, created_ts, dim, q_emb)
+                VALUES(?, ?, ?, ?, ?);
+                """,
+                batch,
+            )
+            con.commit()
+    except sqlite3.Error as e:
+        try:
+            con.rollback()
+        except sqlite3.Error:
+            pass
+        if final:
+            print(f"WARN: при остановке не записали {len(batch)} эмбеддингов в qa_query_cache, они потеряны:", e)
+            return
+        print(f"WARN: не получилось записать {len(batch)} эмбеддингов в qa_query_cache, повторим позже:", e)
+        with _query_cache_write_lock:
+            # старые строки ставим в начало, чтобы более свежие вставки их не перетирали при повторе
+            _query_cache_buffer[:0] = batch
+            _arm_query_cache_timer(con)
 
 
 def load_all_questions(con: sqlite3.Connection) -> List[Tuple[int, str]]:
@@ -149,36 +350,91 @@ def load_all_embeddings(
             f"SELECT qa_id, dim, {vec_col} FROM qa_vec ORDER BY qa_id;"
         ).fetchall()
 
-    ids: List[int] = []
-    vecs: List[np.ndarray] = []
-
-    for qa_id, dim, blob in rows:
-        if blob is None:
-            continue
-        v = np.frombuffer(blob, dtype=np.float32, count=int(dim))
-        ids.append(int(qa_id))
-        vecs.append(v)
-
-    if not vecs:
+    rows = [r for r in rows if r[2] is not None]
+    if not rows:
         raise RuntimeError(
             "Не нашли эмбеддинги в qa_vec. Проверим, что таблица заполнена и вектора (q_vec/a_vec) не NULL."
         )
 
-    X = np.vstack(vecs).astype(np.float32)
-    X = l2_normalize_rows(X)
-    ids_arr = np.asarray(ids, dtype=np.int64)
+    n = len(rows)
+    d = int(rows[0][1])
+    if any(int(dim) != d for _, dim, _ in rows):
+        raise RuntimeError("В qa_vec лежат вектора разной размерности, индекс по ним построить нельзя.")
+
+    # одна матрица (N, D) вместо N отдельных векторов + vstack.
+    # Копируем в формате хранения (float16/float32) без поштучной конвертации,
+    # а в float32 переводим всю матрицу одним векторизованным astype.
+    stored = blob_dtype(rows[0][2], d)
+    X = np.empty((n, d), dtype=stored)
+    ids_arr = np.empty(n, dtype=np.int64)
+    for i, (qa_id, _, blob) in enumerate(rows):
+        ids_arr[i] = qa_id
+        X[i] = blob_to_vec(blob, d)
+    if X.dtype != np.float32:
+        X = X.astype(np.float32)
+
+    # нормализуем на месте, нулевые строки оставляем как есть
+    norms = np.linalg.norm(X, axis=1)
+    X /= np.where(norms == 0, 1.0, norms)[:, None]
 
     return ids_arr, X
 
 
+@functools.lru_cache(maxsize=1)
+def _gpu_usable() -> bool:
+    """GPU реально доступна: FAISS_GPU=1, собран faiss-gpu и видна хотя бы одна карта (считаем один раз)."""
+    return FAISS_GPU and hasattr(faiss, "StandardGpuResources") and faiss.get_num_gpus() > 0
+
+
 def build_faiss_index(X: np.ndarray):
     """
     Строим FAISS индекс по inner product.
     Так как X уже L2-нормирован, inner product соответствует cosine similarity.
+
+    Выбираем тип индекса по размеру базы:
+      - GPU доступна (FAISS_GPU=1 и есть карта) и N < PQ_MIN_N: IndexFlatIP (его можно перенести на GPU)
+      - N < HNSW_MIN_N: полный перебор (IndexFlatIP / IndexScalarQuantizer fp16)
+      - N < PQ_MIN_N:   HNSW-граф (IndexHNSWFlat / IndexHNSWSQ fp16), поиск примерно за log(N)
+      - иначе:          IndexIVFPQ с nlist = sqrt(N), сжатие векторов через product quantization
     """
-    d = int(X.shape[1])
-    index = faiss.IndexFlatIP(d)
-    index.add(np.ascontiguousarray(X, dtype=np.float32))
+    n, d = int(X.shape[0]), int(X.shape[1])
+    X = np.ascontiguousarray(X, dtype=np.float32)
+    metric = faiss.METRIC_INNER_PRODUCT
+
+    if _gpu_usable() and n < PQ_MIN_N:
+        # HNSW и IndexScalarQuantizer на GPU не переносятся; точный перебор на GPU и так быстрый
+        index = faiss.IndexFlatIP(d)
+
+    elif n < HNSW_MIN_N:
+        if FAISS_FP16:
+            index = faiss.IndexScalarQuantizer(d, faiss.ScalarQuantizer.QT_fp16, metric)
+        else:
+            index = faiss.IndexFlatIP(d)
+
+    elif n < PQ_MIN_N:
+        if FAISS_FP16:
+            index = faiss.IndexHNSWSQ(d, faiss.ScalarQuantizer.QT_fp16, HNSW_M, metric)
+        else:
+            index = faiss.IndexHNSWFlat(d, HNSW_M, metric)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+
+    else:
+        nlist = int(np.sqrt(n))
+        # число подвекторов должно делить d; берём ближайшее к d/4
+        m = max(1, d // 4)
+        while d % m:
+            m -= 1
+        quantizer = faiss.IndexFlatIP(d)
+        index = faiss.IndexIVFPQ(quantizer, d, nlist, m, PQ_NBITS, metric)
+
+    if not index.is_trained:
+        index.train(X)
+    index.add(X)
+
+    if hasattr(index, "hnsw"):
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+    if hasattr(index, "nprobe"):
+        index.nprobe = IVF_NPROBE
     return index
 
 
@@ -206,6 +462,188 @@ def dense_topn(
     top_sims = [float(s) for s, i in zip(sims, idxs) if i != -1]
     return top_ids, top_sims
 
+def encode_texts(texts: List[str]) -> np.ndarray:
+    """Кодируем пачку текстов одним вызовом модели: (len(texts), D) float32, L2-нормированные."""
+    embs = _st_model.encode(
+        texts,
+        batch_size=ENCODE_BATCH_SIZE,
+        normalize_embeddings=True,
+        convert_to_numpy=True,
+        show_progress_bar=False,
+    )
+    return np.asarray(embs, dtype=np.float32)
+
+
+async def _encode_worker(queue: asyncio.Queue) -> None:
+    """
+    Фоновая задача микробатчинга:
+    ждём первый запрос, даём ENCODE_BATCH_WINDOW_MS набежать остальным,
+    забираем до ENCODE_BATCH_SIZE штук и кодируем их одним батчем в отдельном потоке.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await queue.get()]
+        await asyncio.sleep(ENCODE_BATCH_WINDOW_MS / 1000.0)
+        while len(batch) < ENCODE_BATCH_SIZE and not queue.empty():
+            batch.append(queue.get_nowait())
+
+        texts = [text for text, _ in batch]
+        try:
+            embs = await loop.run_in_executor(None, encode_texts, texts)
+        except Exception as e:
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            continue
+
+        for (_, fut), emb in zip(batch, embs):
+            if not fut.done():
+                fut.set_result(emb)
+
+
+async def encode_batched(text: str) -> np.ndarray:
+    """Ставим текст в очередь микробатчинга и ждём его эмбеддинг (D,) float32."""
+    global _encode_queue, _encode_task
+
+    loop = asyncio.get_running_loop()
+    # задачу поднимаем лениво в текущем event loop (и перезапускаем, если loop сменился)
+    if _encode_task is None or _encode_task.done() or _encode_task.get_loop() is not loop:
+        _encode_queue = asyncio.Queue()
+        _encode_task = loop.create_task(_encode_worker(_encode_queue))
+
+    fut = loop.create_future()
+    await _encode_queue.put((text, fut))
+    return await fut
+
+
+def index_to_gpu(index):
+    """
+    Переносим CPU-индекс на GPU, если FAISS_GPU=1 и есть карта; иначе возвращаем как есть.
+    Если GPU доступна, build_faiss_index строит только переносимые индексы (IndexFlatIP / IndexIVFPQ);
+    если перенос всё же не удался -- остаёмся на CPU.
+    qa_id (_faiss_ids) всегда держим на CPU, search принимает numpy и сам делает перенос.
+    """
+    global _gpu_res, _faiss_on_gpu
+
+    _faiss_on_gpu = False
+    if not _gpu_usable():
+        return index
+
+    try:
+        if _gpu_res is None:
+            _gpu_res = faiss.StandardGpuResources()
+        gpu_index = faiss.index_cpu_to_gpu(_gpu_res, FAISS_GPU_DEVICE, index)
+    except Exception as e:
+        print("WARN: индекс не переносится на GPU, остаёмся на CPU:", e)
+        return index
+
+    _faiss_on_gpu = True
+    return gpu_index
+
+
+def ensure_vec_meta_table(con: sqlite3.Connection) -> None:
+    """
+    Создаём таблицу с описанием сохранённого на диск индекса:
+    по ней на старте понимаем, актуален ли qa.faiss относительно qa_vec.
+    """
+    cur = con.cursor()
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS qa_vec_meta (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        index_spec TEXT NOT NULL,
+        n_rows INTEGER NOT NULL,
+        max_updated_at TEXT,
+        saved_ts INTEGER NOT NULL
+    );
+    """)
+    con.commit()
+
+
+def qa_vec_fingerprint(con: sqlite3.Connection) -> Tuple[int, Optional[str]]:
+    """Дешёвый «отпечаток» qa_vec: число строк и max(updated_at). Меняется при любом добавлении/обновлении/удалении."""
+    cur = con.cursor()
+    n_rows, max_updated_at = cur.execute("SELECT COUNT(*), MAX(updated_at) FROM qa_vec;").fetchone()
+    return int(n_rows), max_updated_at
+
+
+def index_spec(model_name: str, which_vec: str) -> str:
+    """Описание параметров индекса: если поменяли модель/вектор/настройки FAISS, сохранённый индекс не подходит."""
+    return (
+        f"{model_name}|{which_vec}|fp16={int(FAISS_FP16)}|gpu={int(_gpu_usable())}"
+        f"|hnsw={HNSW_MIN_N},{HNSW_M},{HNSW_EF_CONSTRUCTION}|pq={PQ_MIN_N},{PQ_NBITS}"
+    )
+
+
+def load_saved_index(
+    con: sqlite3.Connection,
+    spec: str,
+    fingerprint: Tuple[int, Optional[str]],
+) -> Optional[Tuple[np.ndarray, object]]:
+    """
+    Пробуем поднять индекс с диска (faiss.read_index + np.load с mmap).
+    Возвращаем (ids, index) или None, если файлов нет или они устарели относительно qa_vec.
+    """
+    if not (os.path.exists(INDEX_PATH) and os.path.exists(IDS_PATH)):
+        return None
+
+    cur = con.cursor()
+    row = cur.execute(
+        "SELECT index_spec, n_rows, max_updated_at FROM qa_vec_meta WHERE id = 1;"
+    ).fetchone()
+    if row is None or (row[0], int(row[1]), row[2]) != (spec, *fingerprint):
+        return None
+
+    try:
+        index = faiss.read_index(INDEX_PATH)
+        ids = np.load(IDS_PATH, mmap_mode="r")
+    except Exception as e:
+        print("WARN: не получилось прочитать сохранённый FAISS индекс, пересобираем:", e)
+        return None
+
+    if int(ids.shape[0]) != int(index.ntotal):
+        return None
+
+    # параметры поиска выставляем заново, от сохранённых не зависим
+    if hasattr(index, "hnsw"):
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+    if hasattr(index, "nprobe"):
+        index.nprobe = IVF_NPROBE
+
+    return ids, index
+
+
+def save_index(
+    con: sqlite3.Connection,
+    index,
+    ids: np.ndarray,
+    spec: str,
+    fingerprint: Tuple[int, Optional[str]],
+) -> None:
+    """
+    Сохраняем индекс и qa_id на диск и записываем их описание в qa_vec_meta.
+    Пишем во временные файлы и подменяем через os.replace, чтобы не оставить полузаписанный индекс.
+    """
+    try:
+        faiss.write_index(index, INDEX_PATH + ".tmp")
+        with open(IDS_PATH + ".tmp", "wb") as f:
+            np.save(f, np.asarray(ids, dtype=np.int64))
+        os.replace(INDEX_PATH + ".tmp", INDEX_PATH)
+        os.replace(IDS_PATH + ".tmp", IDS_PATH)
+    except Exception as e:
+        print("WARN: не получилось сохранить FAISS индекс на диск:", e)
+        return
+
+    cur = con.cursor()
+    cur.execute(
+        """
+        INSERT OR REPLACE INTO qa_vec_meta(id, index_spec, n_rows, max_updated_at, saved_ts)
+        VALUES(1, ?, ?, ?, ?);
+        """,
+        (spec, fingerprint[0], fingerprint[1], int(time.time())),
+    )
+    con.commit()
+
+
 def init_models_once(
     con: Optional[sqlite3.Connection] = None,
     st_model_name: str = DB_MODEL_NAME,
@@ -215,84 +653,171 @@ def init_models_once(
     """
     Вызываем один раз при старте бота:
     - загружаем SentenceTransformer
-    - строим FAISS индекс по эмбеддингам из qa_vec
+    - поднимаем FAISS индекс с диска, если он актуален, иначе строим по эмбеддингам из qa_vec
+    - создаём таблицу кеша эмбеддингов запросов
     """
     global _st_model, _faiss_index, _faiss_ids, _sem_thr
 
-    _sem_thr = float(sem_thr)
+    with _init_lock:
+        _sem_thr = float(sem_thr)
+
+        if _st_model is None:
+            _st_model = SentenceTransformer(st_model_name)
+            # на GPU держим модель в half precision: меньше памяти и быстрее матмулы
+            if torch.cuda.is_available():
+                _st_model = _st_model.half().to("cuda")
+
+        if _faiss_index is None or _faiss_ids is None:
+            if con is None:
+                raise RuntimeError(
+                    "init_models_once(con=...) требует открытое соединение sqlite, чтобы загрузить эмбеддинги qa_vec."
+                )
+
+            loaded = None
+            if FAISS_PERSIST:
+                ensure_vec_meta_table(con)
+                spec = index_spec(st_model_name, which_vec)
+                fingerprint = qa_vec_fingerprint(con)
+                loaded = load_saved_index(con, spec, fingerprint)
+
+            if loaded is not None:
+                _faiss_ids, index = loaded
+            else:
+                ids, X = load_all_embeddings(con, model_name=st_model_name, which_vec=which_vec)
+                _faiss_ids = ids
+                index = build_faiss_index(X)
+                # на диск пишем CPU-версию индекса, на GPU переносим уже после
+                if FAISS_PERSIST:
+                    save_index(con, index, ids, spec, fingerprint)
+
+            _faiss_index = index_to_gpu(index)
+            # старые результаты относятся к прошлому индексу
+            search_cache_clear()
+
+        if CACHE_QUERY_EMB_TO_DB and con is not None:
+            ensure_query_cache_table(con)
+            purge_legacy_query_cache(con)
+
+
+def query_buffer() -> np.ndarray:
+    """Отдаём (1, D) float32 буфер текущего потока под эмбеддинг запроса (создаём при первом вызове / смене D)."""
+    d = int(_faiss_index.d)
+    buf = getattr(_q_buf_local, "buf", None)
+    if buf is None or buf.shape[1] != d:
+        buf = np.empty((1, d), dtype=np.float32)
+        _q_buf_local.buf = buf
+    return buf
+
+
+@functools.lru_cache(maxsize=16)
+def fetch_qa_stmt(k: int) -> str:
+    """SQL для выборки k записей qa по id; один и тот же текст запроса -> sqlite берёт готовый план из кеша стейтментов."""
+    placeholders = ",".join("?" * int(k))
+    return f"SELECT id, page, question, answer_text, source_url FROM qa WHERE id IN ({placeholders});"
+
+
+def fetch_qa_rows(cur: sqlite3.Cursor, ids: List[int]) -> List[tuple]:
+    """
+    Достаём строки (id, page, question, answer_text, source_url) из qa по списку id (порядок не гарантирован).
+    Если id меньше FINAL_K_DEFAULT, добиваем список -1 (таких id нет), чтобы текст SQL всегда был одинаковым.
+    """
+    k = max(len(ids), FINAL_K_DEFAULT)
+    params = list(ids) + [-1] * (k - len(ids))
+    cur.execute(fetch_qa_stmt(k), params)
+    return cur.fetchall()
 
-    if _st_model is None:
-        _st_model = SentenceTransformer(st_model_name)
 
-    if _faiss_index is None or _faiss_ids is None:
-        if con is None:
-            raise RuntimeError(
-                "init_models_once(con=...) требует открытое соединение sqlite, чтобы загрузить эмбеддинги qa_vec."
-            )
+def faiss_topn(q_vec: np.ndarray, top_n: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Синхронный поиск top-N по FAISS для одного эмбеддинга запроса.
+    Возвращаем (qa_id (K,) int64, similarity (K,) float32), пустые слоты FAISS (-1) отброшены.
+    """
+    q_buf = query_buffer()
+    np.copyto(q_buf[0], q_vec)
+    if _faiss_on_gpu:
+        with _gpu_search_lock:
+            sims, idxs = _faiss_index.search(q_buf, int(top_n))
+    else:
+        sims, idxs = _faiss_index.search(q_buf, int(top_n))
+
+    # -1 в idxs -- пустые слоты (кандидатов меньше top_n); отбрасываем их одной маской
+    mask = idxs[0] != -1
+    return _faiss_ids[idxs[0][mask]], sims[0][mask]
+
 
-        ids, X = load_all_embeddings(con, model_name=st_model_name, which_vec=which_vec)
-        _faiss_ids = ids
-        _faiss_index = build_faiss_index(X)
+def fetch_top_rows(con: sqlite3.Connection, ids: List[int], pool=None) -> List[tuple]:
+    """Достаём строки qa по id через read-only соединение из pool (если есть), иначе через con."""
+    if pool is not None:
+        with pool.borrow() as cur:
+            return fetch_qa_rows(cur, ids)
+    return fetch_qa_rows(con.cursor(), ids)
 
 
-def hybrid_search(
+async def hybrid_search(
     con: sqlite3.Connection,
     query: str,
     final_k: int = FINAL_K_DEFAULT,
+    pool=None,
 ) -> Tuple[Optional[tuple], List[tuple], Dict]:
     """
     Возвращаем:
       best_row, top_rows, debug_info
 
+    con -- соединение на запись (кеш эмбеддингов запросов).
+    pool -- опциональный пул read-only соединений (bot.ConnectionPool): если передан,
+    финальный SELECT из qa идёт через pool.borrow(), а не через con.
+
     Делаем так:
       1) получаем top-N по FAISS (cosine similarity)
       2) если лучший similarity < sem_thr — отклоняем (возвращаем пусто)
       3) иначе возвращаем top-K строк из qa
     """
-    query = norm(query)
-    if not query:
+    qn = norm(query)
+    if not qn:
         return None, [], {}
 
     dbg: Dict[str, object] = {}
 
-    # При желании кешируем эмбеддинги запросов в БД
-    if CACHE_QUERY_EMB_TO_DB:
-        ensure_query_cache_table(con)
-
     # Убеждаемся, что модель и индекс загружены
     if _st_model is None or _faiss_index is None or _faiss_ids is None:
         init_models_once(con=con)
 
-    # Берем эмбеддинг запроса из кеша, иначе считаем и кладём в кеш
-    qh = query_hash(query)
-    if CACHE_QUERY_EMB_TO_DB:
-        q_vec = get_cached_query_emb(con, qh)
+    qh = query_hash(qn)
+    top_n = int(max(final_k, TOP_N_DEFAULT))
+
+    # Быстрый путь: такой запрос уже искали -- не считаем эмбеддинг и не ходим в FAISS
+    hit = search_cache_get(qh, top_n)
+    if hit is not None:
+        top_ids, top_sims = hit
+        dbg["search_cache_hit"] = True
     else:
-        q_vec = None
+        dbg["search_cache_hit"] = False
 
-    if q_vec is None:
-        q_vec = _st_model.encode([query], normalize_embeddings=True, show_progress_bar=False)[0].astype(np.float32)
-        if CACHE_QUERY_EMB_TO_DB:
-            put_cached_query_emb(con, qh, query, q_vec)
+        # Берем эмбеддинг запроса из памяти, потом из кеша в БД, иначе считаем и кладём в кеш
+        q_vec = query_emb_cache_get(qh)
+        if q_vec is None and CACHE_QUERY_EMB_TO_DB:
+            q_vec = await asyncio.to_thread(get_cached_query_emb, con, qh, pool)
 
-    # Делаем поиск по FAISS
-    q_vec_2d = q_vec.reshape(1, -1).astype(np.float32)
-    sims, idxs = _faiss_index.search(q_vec_2d, int(max(final_k, TOP_N_DEFAULT)))
+        if q_vec is None:
+            q_vec = await encode_batched(qn)
+            if CACHE_QUERY_EMB_TO_DB:
+                put_cached_query_emb(con, qh, qn, q_vec)
 
-    sims = sims[0]
-    idxs = idxs[0]
+        query_emb_cache_put(qh, q_vec)
 
-    top_ids = [int(_faiss_ids[i]) for i in idxs if i != -1]
-    top_sims = [float(s) for s, i in zip(sims, idxs) if i != -1]
+        # Делаем поиск по FAISS в пуле потоков, чтобы не блокировать event loop
+        top_ids, top_sims = await asyncio.to_thread(faiss_topn, q_vec, top_n)
+
+        search_cache_put(qh, top_n, top_ids, top_sims)
 
     dbg["sem_thr"] = float(_sem_thr)
     dbg["topn_ids"] = top_ids[:TOP_N_DEFAULT]
     dbg["topn_sims"] = top_sims[:TOP_N_DEFAULT]
 
-    if not top_ids:
+    if top_ids.size == 0:
         return None, [], dbg
 
-    best_sim = float(top_sims[0]) if top_sims else -1.0
+    best_sim = float(top_sims[0])
     dbg["best_sim"] = best_sim
 
     # Отклоняем запрос, если похожести недостаточно
@@ -303,21 +828,14 @@ def hybrid_search(
     dbg["rejected"] = False
 
     # Берём top-K для выдачи в бот
-    out_ids = top_ids[: int(final_k)]
-    placeholders = ",".join("?" for _ in out_ids)
-
-    cur = con.cursor()
-    cur.execute(
-        f"""
-        SELECT id, page, question, answer_text, source_url
-        FROM qa
-        WHERE id IN ({placeholders});
-        """,
-        out_ids,
-    )
-    rows = cur.fetchall()
-    row_map = {int(r[0]): r for r in rows}
-    ordered = [row_map[i] for i in out_ids if i in row_map]
+    out_ids = top_ids[: int(final_k)].tolist()
+    rows = await asyncio.to_thread(fetch_top_rows, con, out_ids, pool)
+
+    # раскладываем строки по позициям out_ids за один проход (SQLite порядок IN не сохраняет)
+    slots = dict.fromkeys(out_ids)
+    for r in rows:
+        slots[r[0]] = r
+    ordered = [r for r in slots.values() if r is not None]
 
     best = ordered[0] if ordered else None
     dbg["top_ids"] = out_ids